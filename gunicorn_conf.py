@@ -0,0 +1,14 @@
+import os
+
+# Gunicorn config: multiple Uvicorn workers (uvloop + httptools when installed).
+# Embedder / Qdrant singletons are created lazily per worker.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# forked workers read this to size their ONNX Runtime thread pools
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+worker_connections = 1000
+# ingestion + Gemini calls can exceed gunicorn's 30s default
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
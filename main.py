@@ -7,14 +7,19 @@ logging.basicConfig(level=logging.INFO)
 from fastapi import FastAPI, HTTPException, Security
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.openapi.utils import get_openapi
+from fastapi.responses import ORJSONResponse
 from fastapi.routing import APIRouter
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 import os
+import hashlib
 import tempfile
 from urllib.parse import urlparse
 import asyncio
+import functools
+import time
 import httpx  # for async HTTP requests
+from concurrent.futures import ThreadPoolExecutor
 
 # Local .env only for local dev
 if os.getenv("RENDER") != "true":
@@ -24,7 +29,39 @@ if os.getenv("RENDER") != "true":
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 API_KEY = os.getenv("API_KEY")
 
-app = FastAPI()
+# Max in-flight Gemini calls per request
+GEMINI_CONCURRENCY = 8
+# Read size when streaming document downloads to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Default executor size for asyncio.to_thread offloading
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "16"))
+# Gemini context caching needs a pinned model version
+CONTEXT_CACHE_MODEL = "models/gemini-1.5-flash-002"
+CONTEXT_CACHE_TTL_SECONDS = 600
+# Gemini only caches >= 32,768 tokens; ~4 chars per token
+CONTEXT_CACHE_MIN_CHARS = 4 * 32768
+
+# Prompt templates (built once at import, filled per question)
+ANSWER_PROMPT = (
+    "Answer this insurance policy question accurately and concisely:\n"
+    "Question: {question}\n"
+    "Relevant Policy Clauses:\n{context}\n"
+    "Answer in one clear sentence under 30 words."
+)
+CACHED_POLICY_PROMPT = (
+    "Answer this insurance policy question accurately and concisely "
+    "using the cached policy document, focusing on the pages with these markers:\n"
+    "Question: {question}\n"
+    "Most Relevant Pages:\n{pointers}\n"
+    "Answer in one clear sentence under 30 words."
+)
+
+
+def page_marker(page):
+    """Page label used both in the cached policy text and in per-question pointers."""
+    return f"[Page {page}]"
+
+app = FastAPI(default_response_class=ORJSONResponse)
 router = APIRouter(prefix="/api/v1")
 
 api_key_header = APIKeyHeader(name="Authorization")
@@ -33,27 +70,71 @@ api_key_header = APIKeyHeader(name="Authorization")
 class HackRxRequest(BaseModel):
     documents: str
     questions: List[str]
+    # point IDs returned as context_ids by an earlier call, for follow-up questions
+    previous_context_ids: Optional[List[str]] = None
+
+
+# --- Worker threads for blocking parsing / embedding / SDK calls ---
+@app.on_event("startup")
+async def startup_executor():
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+    )
+
+
+# --- Shared HTTP client: keep-alive pool reused across requests ---
+@app.on_event("startup")
+async def startup_http_client():
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    await app.state.http.aclose()
 
 
 # --- Warmup: run non-blocking background task after startup ---
 @app.on_event("startup")
 async def startup_warmup():
     """
-    Attempt to warm embeddings in background so the first user request is faster.
+    Warm embeddings, the Qdrant index and the Gemini connection in parallel in the
+    background so the first user request is faster.
     This does not block app startup (important to avoid Render timeout).
     """
-    async def _warm_embeddings():
+    async def _warm(name, start):
+        try:
+            await start()
+            logging.info(f"✅ Background: {name} warmup complete")
+        except Exception as e:
+            logging.warning(f"⚠️ Background: {name} warmup failed: {e}")
+
+    async def _warm_all():
         try:
             from utils import embedder
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: embedder.get_embeddings().embed_query("warmup"))
-            logging.info("✅ Background: embeddings warmup complete")
         except Exception as e:
-            logging.warning(f"⚠️ Background: embeddings warmup failed: {e}")
+            logging.warning(f"⚠️ Background: warmup skipped, embedder import failed: {e}")
+            return
+
+        loop = asyncio.get_running_loop()
+        # any unit vector works for touching the HNSW graph; avoids waiting on the embedder
+        probe = [1.0 / embedder.VECTOR_SIZE ** 0.5] * embedder.VECTOR_SIZE
+
+        await asyncio.gather(
+            _warm("embeddings", lambda: loop.run_in_executor(
+                None, lambda: embedder.get_embeddings().embed_query("warmup"))),
+            _warm("Qdrant", lambda: loop.run_in_executor(
+                None, lambda: embedder.search_qdrant_batch([probe], k=1))),
+            _warm("Gemini", lambda: get_gemini_model().generate_content_async("ping")),
+        )
 
-    asyncio.create_task(_warm_embeddings())
+    asyncio.create_task(_warm_all())
 
 
+@functools.lru_cache(maxsize=1)
 def get_gemini_model():
     """
     Lazily create / cache the Gemini model inside google.generativeai.
@@ -63,6 +144,52 @@ def get_gemini_model():
     return genai.GenerativeModel("gemini-1.5-flash")
 
 
+# doc_id -> (model bound to the cached policy text, expiry as time.monotonic())
+_policy_models = {}
+
+
+def get_policy_model(doc_id, policy_text=None):
+    """
+    Return a Gemini model bound to a context cache of the policy text, or None.
+    The cache is created when policy_text is given; Gemini rejects texts below its
+    minimum cacheable size, in which case callers fall back to get_gemini_model().
+    """
+    entry = _policy_models.get(doc_id)
+    if entry is not None:
+        if entry[1] > time.monotonic():
+            return entry[0]
+        _policy_models.pop(doc_id, None)
+    if policy_text is None:
+        return None
+    if len(policy_text) < CONTEXT_CACHE_MIN_CHARS:
+        # below Gemini's minimum cacheable size: creation would only fail
+        return None
+
+    import datetime
+    import google.generativeai as genai
+    from google.generativeai import caching
+    get_gemini_model()  # ensures genai is configured
+    try:
+        cache = caching.CachedContent.create(
+            model=CONTEXT_CACHE_MODEL,
+            display_name=doc_id,
+            contents=[policy_text],
+            ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+        )
+    except Exception as e:
+        logging.warning(f"⚠️ Gemini context cache not created for {doc_id}: {e}")
+        return None
+    model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+    # expire locally a little before Gemini does
+    _policy_models[doc_id] = (model, time.monotonic() + CONTEXT_CACHE_TTL_SECONDS - 30)
+    return model
+
+
+def _unique_ids(id_lists):
+    """Flatten per-question point ID lists, keeping first-seen order."""
+    return list(dict.fromkeys(i for ids in id_lists for i in ids))
+
+
 @router.post("/hackrx/run")
 async def hackrx_run(payload: HackRxRequest, authorization: str = Security(api_key_header)):
     # Auth check
@@ -71,54 +198,150 @@ async def hackrx_run(payload: HackRxRequest, authorization: str = Security(api_k
 
     try:
         logging.info("Starting document download...")
-        async with httpx.AsyncClient(timeout=30) as client:
-            resp = await client.get(payload.documents)
-            resp.raise_for_status()
-            content = resp.content
-        logging.info(f"Document downloaded, size: {len(content)} bytes")
-
         url_path = urlparse(payload.documents).path
         suffix = os.path.splitext(url_path)[1] or ".pdf"
+        hasher = hashlib.sha256()
+        size = 0
+        # Stream straight to disk, hashing as we go, instead of buffering the whole body
         with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(content)
             tmp_path = tmp.name
+            async with app.state.http.stream("GET", payload.documents) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    tmp.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+        logging.info(f"Document downloaded, size: {size} bytes")
+        doc_hash = hasher.hexdigest()
+
+        # Exact (document, question) pairs answered before skip the whole pipeline
+        from utils.answer_cache import get_cached_answer, cache_answer
+        cached_entries = await asyncio.to_thread(
+            lambda: [get_cached_answer(doc_hash, q) for q in payload.questions]
+        )
+        answers = [entry[0] if entry else None for entry in cached_entries]
+        # Qdrant point IDs behind each answer, returned so clients can ask follow-ups
+        question_ids = [list(entry[1]) if entry else [] for entry in cached_entries]
+        pending = [i for i, a in enumerate(answers) if a is None]
+        if not pending:
+            logging.info("All answers served from answer cache, skipping ingestion")
+            return {"answers": answers, "context_ids": _unique_ids(question_ids)}
 
-        logging.info("Starting chunking document...")
         from utils.loader import load_and_chunk
-        from utils.embedder import store_chunks_qdrant, load_qdrant
+        from utils.embedder import (
+            store_chunks_qdrant, get_embeddings, search_qdrant_batch_async,
+            recommend_qdrant_batch_async, filter_context_ids_async, document_exists_async
+        )
+        from utils.proxcache import proximity_cache
 
-        chunks = load_and_chunk(tmp_path)
-        logging.info(f"Chunking done, {len(chunks)} chunks created")
+        # Identical document bytes were already ingested: reuse their vectors
+        doc_id = doc_hash[:16]
+        policy_model = None
+        if await document_exists_async(doc_id):
+            logging.info(f"Document {doc_id} already in Qdrant, skipping ingestion")
+            policy_model = get_policy_model(doc_id)
+        else:
+            logging.info("Starting chunking document...")
+            chunks = await asyncio.to_thread(load_and_chunk, tmp_path, doc_hash)
+            logging.info(f"Chunking done, {len(chunks)} chunks created")
 
-        logging.info("Storing chunks in Qdrant...")
-        store_chunks_qdrant(chunks)
-        logging.info("Chunks stored successfully")
+            logging.info("Storing chunks in Qdrant...")
+            await asyncio.to_thread(store_chunks_qdrant, chunks, doc_id)
+            logging.info("Chunks stored successfully")
 
-        logging.info("Loading Qdrant vectorstore...")
-        db = load_qdrant()
-        logging.info("Qdrant vectorstore loaded")
+            # Send the policy text to Gemini once; questions then reference the cache
+            policy_text = "\n\n".join(
+                f"{page_marker(chunk.metadata.get('page'))}\n{chunk.page_content}" for chunk in chunks
+            )
+            policy_model = await asyncio.to_thread(get_policy_model, doc_id, policy_text)
 
         logging.info("Generating answers...")
         model = get_gemini_model()
 
-        answers = []
-        for question in payload.questions:
-            docs = db.similarity_search(question, k=4)
-            context = "\n\n".join([f"Document Clause: {d.page_content}" for d in docs])
-            prompt = (
-                f"Answer this insurance policy question accurately and concisely:\n"
-                f"Question: {question}\n"
-                f"Relevant Policy Clauses:\n{context}\n"
-                "Answer in one clear sentence under 30 words."
-            )
+        # Embed all uncached questions in one batched forward pass
+        pending_questions = [payload.questions[i] for i in pending]
+        # get_embeddings() may still have to load the model on a cold worker: keep it off the loop
+        pending_vecs = await asyncio.to_thread(
+            lambda: get_embeddings().embed_documents(pending_questions)
+        )
+        qvecs = dict(zip(pending, pending_vecs))
+
+        # Near-duplicate questions on the same document are served from the proximity cache
+        misses = []
+        for i in pending:
+            cached = proximity_cache.lookup(doc_hash, qvecs[i])
+            if cached is not None:
+                question_ids[i], answers[i] = list(cached[0]), cached[1]
+            else:
+                misses.append(i)
+        logging.info(f"Proximity cache: {len(pending) - len(misses)} hits, {len(misses)} misses")
+
+        # Retrieve every uncached question's neighbours in one Qdrant round-trip;
+        # follow-ups also get Recommendation API hits anchored to the previous context
+        miss_vecs = [qvecs[i] for i in misses]
+        hits_per_question = None
+        if misses and payload.previous_context_ids:
             try:
-                answer = model.generate_content(prompt).text.strip()
-                answers.append(answer)
+                prev_ids = await filter_context_ids_async(payload.previous_context_ids, doc_id)
+                if prev_ids:
+                    hits_per_question = await recommend_qdrant_batch_async(
+                        prev_ids, miss_vecs, k=4, doc_id=doc_id
+                    )
+                else:
+                    logging.warning("No usable previous_context_ids for this document, using plain search")
             except Exception as e:
-                answers.append(f"Error generating answer: {str(e)}")
+                logging.warning(f"⚠️ Recommendation failed, falling back to plain search: {e}")
+        if hits_per_question is None:
+            hits_per_question = await search_qdrant_batch_async(miss_vecs, k=4, doc_id=doc_id) if misses else []
+        for i, hits in zip(misses, hits_per_question):
+            question_ids[i] = [str(h.id) for h in hits]
+        semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+        # Questions often share top-k hits: format each point's (page marker, clause block) once
+        hit_text_cache = {}
+
+        def _hit_text(hit):
+            text = hit_text_cache.get(hit.id)
+            if text is None:
+                md = hit.payload.get("metadata") or {}
+                header = f"Document: {md.get('source', 'unknown')} | Page: {md.get('page', '-')}"
+                text = hit_text_cache[hit.id] = (
+                    page_marker(md.get("page")),
+                    f"{header}\nClause: {hit.payload['page_content']}"
+                )
+            return text
+
+        async def _answer_one(question, qvec, hits):
+            texts = [_hit_text(h) for h in hits]
+            if policy_model is not None:
+                # Clause text is already in the cached policy; send the matching page markers only
+                pointers = "\n".join(dict.fromkeys(marker for marker, _ in texts))
+                prompt = CACHED_POLICY_PROMPT.format(question=question, pointers=pointers)
+                response = await policy_model.generate_content_async(prompt)
+            else:
+                context = "\n\n".join(block for _, block in texts)
+                prompt = ANSWER_PROMPT.format(question=question, context=context)
+                response = await model.generate_content_async(prompt)
+            answer = response.text.strip()
+            hit_ids = [str(h.id) for h in hits]
+            proximity_cache.put(doc_hash, qvec, hit_ids, answer)
+            await asyncio.to_thread(cache_answer, doc_hash, question, answer, hit_ids)
+            return answer
+
+        async def _bounded_answer(i, hits):
+            async with semaphore:
+                return await _answer_one(payload.questions[i], qvecs[i], hits)
+
+        # Dispatch all questions concurrently; the async Gemini client multiplexes them on the loop
+        results = await asyncio.gather(
+            *[_bounded_answer(i, h) for i, h in zip(misses, hits_per_question)],
+            return_exceptions=True,
+        )
+        for i, r in zip(misses, results):
+            answers[i] = f"Error generating answer: {str(r)}" if isinstance(r, Exception) else r
 
         logging.info("Answers generated, returning response")
-        return {"answers": answers}
+        return {"answers": answers, "context_ids": _unique_ids(question_ids)}
 
     except httpx.RequestError as e:
         logging.error(f"Failed to download document: {e}")
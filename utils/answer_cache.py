@@ -0,0 +1,62 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# On-disk answer cache location (survives process restarts)
+ANSWER_CACHE_DIR = "/tmp/hackrx_cache"
+# In-process LRU in front of the disk cache
+MEMORY_CACHE_SIZE = 512
+
+# singleton (cached)
+_cache_instance = None
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Get or initialize the on-disk answer cache (singleton)."""
+    global _cache_instance
+    if _cache_instance is None:
+        import diskcache
+        _cache_instance = diskcache.Cache(ANSWER_CACHE_DIR)
+    return _cache_instance
+
+
+def _answer_key(doc_hash, question):
+    # case / surrounding whitespace do not change the question
+    normalized = question.strip().lower()
+    return f"{doc_hash}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+
+def _remember(key, entry):
+    with _memory_lock:
+        _memory_cache[key] = entry
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def get_cached_answer(doc_hash, question):
+    """Return the cached (answer, context_ids) for (document, question), or None."""
+    key = _answer_key(doc_hash, question)
+    with _memory_lock:
+        entry = _memory_cache.get(key)
+        if entry is not None:
+            _memory_cache.move_to_end(key)
+            return entry
+    entry = get_answer_cache().get(key)
+    if entry is None:
+        return None
+    if isinstance(entry, str):
+        # written before context IDs were cached
+        entry = (entry, [])
+    _remember(key, entry)
+    return entry
+
+
+def cache_answer(doc_hash, question, answer, context_ids=()):
+    """Store the answer and the Qdrant point IDs it was based on for (document, question)."""
+    key = _answer_key(doc_hash, question)
+    entry = (answer, list(context_ids))
+    get_answer_cache()[key] = entry
+    _remember(key, entry)
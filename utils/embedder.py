@@ -1,4 +1,9 @@
 import os
+import math
+import uuid
+import asyncio
+import threading
+import functools
 from dotenv import load_dotenv
 
 # Load local .env only for local dev (Render injects env vars)
@@ -9,113 +14,420 @@ if os.getenv("RENDER") != "true":
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 QDRANT_COLLECTION = "insurance_docs"
+# all-MiniLM-L6-v2 output dimension
+VECTOR_SIZE = 384
+# ONNX export of all-MiniLM-L6-v2 with int8 dynamic quantization
+ONNX_MODEL_REPO = "Xenova/all-MiniLM-L6-v2"
+ONNX_MODEL_FILE = "onnx/model_quantized.onnx"
+# Only the payload fields the prompt builder reads
+SEARCH_PAYLOAD_FIELDS = ["page_content", "metadata.source", "metadata.page"]
+# Chunk metadata is nested under the "metadata" payload key (LangChain's layout)
+DOC_ID_FIELD = "metadata.doc_id"
+# Set only on the per-document marker point written after a complete upload
+INGEST_MARKER_FIELD = "metadata.ingest_complete"
+# Cap on previous point IDs used as recommendation examples per follow-up
+MAX_CONTEXT_POSITIVES = 8
+# Points per upload request; also sizes the upload worker count
+UPLOAD_BATCH_SIZE = 256
 
 # singletons (cached)
 _embeddings_instance = None
+_embeddings_lock = threading.Lock()
 _qdrant_client_instance = None
-_qdrant_vectorstore_instance = None
+_async_qdrant_client_instance = None
+# set once the collection is known to exist (skips the get_collections round-trip)
+_collection_ready = False
+
+
+class OnnxMiniLMEmbeddings:
+    """
+    all-MiniLM-L6-v2 with int8 dynamically quantized weights, run on ONNX Runtime's
+    CPU execution provider (exposes embed_documents / embed_query).
+    """
+
+    def __init__(self, repo_id=ONNX_MODEL_REPO, model_file=ONNX_MODEL_FILE, batch_size=64, max_length=256):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        self.batch_size = batch_size
+        self._tokenizer = Tokenizer.from_file(hf_hub_download(repo_id, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=max_length)
+        self._tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        # reuse activation buffers across runs of the same batch shape
+        options.enable_mem_pattern = True
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # split cores between gunicorn workers instead of oversubscribing them
+        workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+        options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // workers)
+        self._session = ort.InferenceSession(
+            hf_hub_download(repo_id, model_file),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+
+    def _embed_batch(self, texts):
+        import numpy as np
+
+        encodings = self._tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = self._session.run(None, feeds)[0]
+
+        # mean pooling over real tokens, then L2-normalize (sentence-transformers recipe)
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed_batch(texts[start:start + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
 
 
 def get_embeddings():
-    """Get or initialize HuggingFace embeddings (singleton)."""
+    """Get or initialize int8 ONNX MiniLM embeddings (singleton, thread-safe)."""
     global _embeddings_instance
     if _embeddings_instance is None:
-        # import inside function to avoid import-time cost
-        from langchain_huggingface import HuggingFaceEmbeddings
-        print("⚡ Loading HuggingFace embeddings model...")
-        _embeddings_instance = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        # warmup and request threads may race here; load the model only once
+        with _embeddings_lock:
+            if _embeddings_instance is None:
+                print("⚡ Loading ONNX int8 embeddings model...")
+                _embeddings_instance = OnnxMiniLMEmbeddings(batch_size=64)
     return _embeddings_instance
 
 
+@functools.lru_cache(maxsize=4096)
+def _embed_normalized_query(query):
+    return tuple(get_embeddings().embed_query(query))
+
+
+def embed_query_cached(query):
+    """
+    Embed a search query, reusing vectors for repeated queries (LRU cache).
+    MiniLM is uncased, so queries are normalized with strip().lower().
+    """
+    return list(_embed_normalized_query(query.strip().lower()))
+
+
 def get_qdrant_client():
     """Get or initialize Qdrant client (singleton)."""
     global _qdrant_client_instance
     if _qdrant_client_instance is None:
         from qdrant_client import QdrantClient
         print("⚡ Connecting to Qdrant Cloud...")
+        # gRPC: protobuf-packed vectors over a persistent HTTP/2 channel
         _qdrant_client_instance = QdrantClient(
             url=QDRANT_URL,
-            api_key=QDRANT_API_KEY
+            api_key=QDRANT_API_KEY,
+            prefer_grpc=True,
+            grpc_port=6334,
+            timeout=10
         )
     return _qdrant_client_instance
 
 
-def get_qdrant_vectorstore():
-    """Get or initialize a LangChain Qdrant vectorstore (singleton)."""
-    global _qdrant_vectorstore_instance
-    if _qdrant_vectorstore_instance is None:
-        from langchain_qdrant import Qdrant
-        print("⚡ Initializing Qdrant vectorstore wrapper...")
-        _qdrant_vectorstore_instance = Qdrant(
-            client=get_qdrant_client(),
+def get_async_qdrant_client():
+    """Get or initialize async Qdrant client (singleton)."""
+    global _async_qdrant_client_instance
+    if _async_qdrant_client_instance is None:
+        from qdrant_client import AsyncQdrantClient
+        print("⚡ Connecting async client to Qdrant Cloud...")
+        _async_qdrant_client_instance = AsyncQdrantClient(
+            url=QDRANT_URL,
+            api_key=QDRANT_API_KEY,
+            prefer_grpc=True,
+            grpc_port=6334,
+            timeout=10
+        )
+    return _async_qdrant_client_instance
+
+
+def _chunk_filter(doc_id=None):
+    """Filter matching chunk points (never ingest markers), optionally of one document."""
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+    must = [FieldCondition(key=DOC_ID_FIELD, match=MatchValue(value=doc_id))] if doc_id is not None else None
+    return Filter(
+        must=must,
+        must_not=[FieldCondition(key=INGEST_MARKER_FIELD, match=MatchValue(value=True))]
+    )
+
+
+def _ingest_marker_filter(doc_id):
+    from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+    return Filter(must=[
+        FieldCondition(key=DOC_ID_FIELD, match=MatchValue(value=doc_id)),
+        FieldCondition(key=INGEST_MARKER_FIELD, match=MatchValue(value=True))
+    ])
+
+
+def _point_id(doc_id, name):
+    # deterministic IDs: re-ingesting a document overwrites its points instead of duplicating them
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{QDRANT_COLLECTION}/{doc_id}/{name}"))
+
+
+def quantized_search_params():
+    """
+    Search params for the int8-quantized collection: scan the quantized vectors,
+    then rescore 2x oversampled candidates with the original vectors.
+    """
+    from qdrant_client.http.models import SearchParams, QuantizationSearchParams
+    return SearchParams(
+        quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
+    )
+
+
+async def document_exists_async(doc_id):
+    """
+    Returns True if doc_id was fully ingested, i.e. its ingest marker point exists.
+    """
+    try:
+        result = await get_async_qdrant_client().count(
             collection_name=QDRANT_COLLECTION,
-            embeddings=get_embeddings()
+            count_filter=_ingest_marker_filter(doc_id),
+            exact=True
         )
-    return _qdrant_vectorstore_instance
+    except Exception as e:
+        # Missing collection (first upload) or transient error: fall back to ingesting
+        print(f"⚠️ Could not check for document '{doc_id}': {e}")
+        return False
+    return result.count > 0
 
 
-def store_chunks_qdrant(chunks):
+def store_chunks_qdrant(chunks, doc_id=None):
     """
     Stores document chunks in Qdrant Cloud collection.
     chunks: list of LangChain Document objects
+    doc_id: optional document identifier added to every chunk's metadata; an ingest
+            marker point is written for it once every chunk is uploaded
     """
     if not chunks:
         raise ValueError("Chunks list is empty.")
 
-    from qdrant_client.http.models import VectorParams, Distance
+    from qdrant_client.http.models import (
+        VectorParams, Distance, PayloadSchemaType, ScalarQuantization, ScalarQuantizationConfig,
+        ScalarType, PointStruct
+    )
 
     embeddings = get_embeddings()
     qdrant_client = get_qdrant_client()
-    vectorstore = get_qdrant_vectorstore()
 
     texts = [doc.page_content for doc in chunks]
     metadatas = [doc.metadata for doc in chunks]
+    if doc_id is not None:
+        metadatas = [{**m, "doc_id": doc_id} for m in metadatas]
 
     print(f"📤 Uploading {len(texts)} chunks to Qdrant Cloud...")
 
-    # Ensure collection exists
-    try:
-        existing_collections = [col.name for col in qdrant_client.get_collections().collections]
-    except Exception as e:
-        # If client.get_collections() fails, still proceed to vectorstore which will raise a clearer error
-        print(f"⚠️ Could not list collections: {e}")
-        existing_collections = []
+    # Ensure collection exists (checked once per process)
+    global _collection_ready
+    if not _collection_ready:
+        # int8 vectors kept in RAM (4x smaller); searches rescore with the originals.
+        # Binary quantization loses too much recall at MiniLM's 384 dims.
+        quantization_config = ScalarQuantization(
+            scalar=ScalarQuantizationConfig(
+                type=ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+        try:
+            existing_collections = [col.name for col in qdrant_client.get_collections().collections]
+        except Exception as e:
+            # If client.get_collections() fails, still proceed to the upload which will raise a clearer error
+            print(f"⚠️ Could not list collections: {e}")
+            existing_collections = []
 
-    if QDRANT_COLLECTION not in existing_collections:
-        print(f"⚙️ Creating Qdrant collection '{QDRANT_COLLECTION}'...")
-        qdrant_client.create_collection(
-            collection_name=QDRANT_COLLECTION,
-            vectors_config=VectorParams(
-                size=384,
-                distance=Distance.COSINE
+        if QDRANT_COLLECTION not in existing_collections:
+            print(f"⚙️ Creating Qdrant collection '{QDRANT_COLLECTION}'...")
+            qdrant_client.create_collection(
+                collection_name=QDRANT_COLLECTION,
+                vectors_config=VectorParams(
+                    size=VECTOR_SIZE,
+                    distance=Distance.COSINE
+                ),
+                quantization_config=quantization_config
+            )
+        elif qdrant_client.get_collection(QDRANT_COLLECTION).config.quantization_config is None:
+            # collection predates quantization: enable it in place (Qdrant rebuilds in the background)
+            print(f"⚙️ Enabling int8 quantization on '{QDRANT_COLLECTION}'...")
+            qdrant_client.update_collection(
+                collection_name=QDRANT_COLLECTION,
+                quantization_config=quantization_config
             )
+        # Index the filter fields (idempotent; also covers collections created elsewhere)
+        qdrant_client.create_payload_index(
+            collection_name=QDRANT_COLLECTION,
+            field_name=DOC_ID_FIELD,
+            field_schema=PayloadSchemaType.KEYWORD
+        )
+        qdrant_client.create_payload_index(
+            collection_name=QDRANT_COLLECTION,
+            field_name=INGEST_MARKER_FIELD,
+            field_schema=PayloadSchemaType.BOOL
         )
+        _collection_ready = True
 
-    # add_texts uses the existing vectorstore and embeddings
-    try:
-        # prefer add_texts when available to avoid re-initializing internals
-        vectorstore.add_texts(texts=texts, metadatas=metadatas)
-    except Exception:
-        # fallback to from_texts if needed by the current langchain version
-        from langchain_qdrant import Qdrant
-        Qdrant.from_texts(
-            texts=texts,
-            embedding=embeddings,
-            metadatas=metadatas,
-            url=QDRANT_URL,
-            api_key=QDRANT_API_KEY,
-            collection_name=QDRANT_COLLECTION
+    # Embed all chunks in batched forward passes, then bulk-upload in parallel.
+    # Payload keeps LangChain's page_content / metadata layout so previously ingested points stay readable.
+    vectors = embeddings.embed_documents(texts)
+    payloads = [
+        {"page_content": text, "metadata": metadata}
+        for text, metadata in zip(texts, metadatas)
+    ]
+    qdrant_client.upload_collection(
+        collection_name=QDRANT_COLLECTION,
+        vectors=vectors,
+        payload=payloads,
+        ids=[_point_id(doc_id, i) for i in range(len(texts))] if doc_id is not None else None,
+        batch_size=UPLOAD_BATCH_SIZE,
+        # one worker per batch: extra processes only pay off on large documents
+        parallel=min(4, math.ceil(len(texts) / UPLOAD_BATCH_SIZE)),
+        # points must be searchable as soon as this returns
+        wait=True
+    )
+
+    if doc_id is not None:
+        # Written last: document_exists_async() only sees the document after a complete upload
+        qdrant_client.upsert(
+            collection_name=QDRANT_COLLECTION,
+            points=[PointStruct(
+                id=_point_id(doc_id, "ingest-marker"),
+                vector=vectors[0],
+                payload={"page_content": "", "metadata": {"doc_id": doc_id, "ingest_complete": True}}
+            )],
+            wait=True
         )
 
     print("✅ Chunks stored successfully in Qdrant Cloud.")
 
 
-def load_qdrant():
+def _search_requests(query_vectors, k, doc_id):
+    from qdrant_client.http.models import SearchRequest
+
+    query_filter = _chunk_filter(doc_id)
+    search_params = quantized_search_params()
+    return [
+        SearchRequest(
+            vector=vec,
+            limit=k,
+            filter=query_filter,
+            params=search_params,
+            with_payload=SEARCH_PAYLOAD_FIELDS,
+            with_vector=False
+        )
+        for vec in query_vectors
+    ]
+
+
+def _recommend_requests(context_ids, query_vectors, k, doc_id):
+    from qdrant_client.http.models import RecommendRequest, RecommendStrategy
+
+    query_filter = _chunk_filter(doc_id)
+    search_params = quantized_search_params()
+    positives = list(context_ids)[:MAX_CONTEXT_POSITIVES]
+    return [
+        RecommendRequest(
+            positive=[*positives, vec],
+            # score candidates by their best-matching example instead of averaging
+            # all examples, so the question vector is not drowned out
+            strategy=RecommendStrategy.BEST_SCORE,
+            limit=k,
+            filter=query_filter,
+            params=search_params,
+            with_payload=SEARCH_PAYLOAD_FIELDS,
+            with_vector=False
+        )
+        for vec in query_vectors
+    ]
+
+
+def search_qdrant_batch(query_vectors, k=4, doc_id=None):
+    """
+    Runs one top-k search per query vector in a single Qdrant round-trip.
+    If doc_id is given, only chunks of that document are searched.
+    Returns a list of ScoredPoint lists, in the same order as query_vectors.
     """
-    Loads existing Qdrant collection as a retriever (cached).
+    return get_qdrant_client().search_batch(
+        collection_name=QDRANT_COLLECTION,
+        requests=_search_requests(query_vectors, k, doc_id)
+    )
+
+
+async def search_qdrant_batch_async(query_vectors, k=4, doc_id=None):
+    """
+    Async variant of search_qdrant_batch (runs on the event loop, no worker thread).
     """
-    print("📥 Loading Qdrant collection (cached wrapper)...")
-    return get_qdrant_vectorstore()
+    return await get_async_qdrant_client().search_batch(
+        collection_name=QDRANT_COLLECTION,
+        requests=_search_requests(query_vectors, k, doc_id)
+    )
+
+
+async def filter_context_ids_async(context_ids, doc_id):
+    """
+    Keep only client-supplied point IDs that are well-formed and belong to
+    doc_id's chunks, so they are safe to pass to recommend_qdrant_batch_async.
+    """
+    ids = []
+    for context_id in context_ids:
+        try:
+            ids.append(str(uuid.UUID(str(context_id))))
+        except ValueError:
+            continue
+    if not ids:
+        return []
+    points = await get_async_qdrant_client().retrieve(
+        collection_name=QDRANT_COLLECTION,
+        ids=list(dict.fromkeys(ids)),
+        with_payload=[DOC_ID_FIELD, INGEST_MARKER_FIELD],
+        with_vectors=False
+    )
+    valid = []
+    for point in points:
+        metadata = (point.payload or {}).get("metadata") or {}
+        if metadata.get("doc_id") == doc_id and not metadata.get("ingest_complete"):
+            valid.append(str(point.id))
+    return valid
+
+
+async def recommend_qdrant_batch_async(context_ids, query_vectors, k=4, doc_id=None):
+    """
+    Retrieval for follow-up questions: a plain search_batch merged with Qdrant's
+    Recommendation API, using previously retrieved point IDs as extra positive
+    examples next to each query vector.
+    The plain search hits come first, because Recommendation never returns the
+    example points themselves, and the earlier clauses may be what the follow-up
+    is about. Returns up to 2 * k deduplicated hits per query vector.
+    """
+    client = get_async_qdrant_client()
+    searched, recommended = await asyncio.gather(
+        client.search_batch(
+            collection_name=QDRANT_COLLECTION,
+            requests=_search_requests(query_vectors, k, doc_id)
+        ),
+        client.recommend_batch(
+            collection_name=QDRANT_COLLECTION,
+            requests=_recommend_requests(context_ids, query_vectors, k, doc_id)
+        )
+    )
+    merged = []
+    for search_hits, recommend_hits in zip(searched, recommended):
+        seen = {hit.id for hit in search_hits}
+        merged.append(list(search_hits) + [hit for hit in recommend_hits if hit.id not in seen])
+    return merged
 
 
 # Optional: try a safe preload on import, but don't crash if it fails.
@@ -1,43 +1,191 @@
 import os
+import hashlib
+import pickle
+import re
+import threading
 from langchain_core.documents import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-def load_and_chunk(file_path):
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# PDFs with fewer pages are extracted inline (pool startup would dominate)
+PARALLEL_PAGE_THRESHOLD = 32
+# Parsed chunks are cached here, keyed by file content hash
+CHUNK_CACHE_DIR = os.path.expanduser("~/.cache/bajaj_chunks")
+# bump when chunk text processing changes, so stale cache files are ignored
+CHUNK_CACHE_VERSION = 2
+# Least recently used cache files beyond this count are deleted
+CHUNK_CACHE_MAX_FILES = 256
+
+# PDF text is full of line breaks / runs of spaces that only cost prompt tokens
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_whitespace(text):
+    """Collapse every whitespace run to a single space."""
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def fast_chunk(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Split text into fixed-size windows with a fixed overlap.
+    Plain slicing over precomputed offsets, no separator search.
+    """
+    step = size - overlap
+    # stop before a trailing window that would only repeat the previous overlap
+    chunks = (text[i:i + size].strip() for i in range(0, max(len(text) - overlap, 1), step))
+    return [chunk for chunk in chunks if chunk]
+
+
+# shared PDF extraction pool (created on first large PDF)
+_extract_pool = None
+_extract_pool_size = 0
+_extract_pool_lock = threading.Lock()
+
+
+def _extract_page_range(file_path, start, stop):
+    import fitz
+    with fitz.open(file_path) as pdf:
+        return [pdf[i].get_text("text") for i in range(start, stop)]
+
+
+def _get_extract_pool():
+    """
+    Get or initialize the PDF extraction process pool (singleton), or None when
+    this worker's share of cores is too small to parallelize.
+    Uses "spawn": forking a process holding gRPC channels / ONNX Runtime threads is unsafe.
+    """
+    global _extract_pool, _extract_pool_size
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+            size = (os.cpu_count() or 1) // workers
+            if size < 2:
+                return None
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _extract_pool_size = size
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _extract_pool
+
+
+def extract_pdf_pages(file_path):
+    """
+    Return the text of every PDF page, in order.
+    Large PDFs are split into page ranges extracted in parallel on a shared
+    process pool; each worker opens its own handle since PyMuPDF documents are
+    not thread-safe.
+    """
+    # Lazy import to speed up startup; PyMuPDF's C extractor is much faster than pypdf
+    import fitz
+    with fitz.open(file_path) as pdf:
+        page_count = pdf.page_count
+        pool = _get_extract_pool() if page_count >= PARALLEL_PAGE_THRESHOLD else None
+        if pool is None:
+            return [page.get_text("text") for page in pdf]
+
+    ranges = min(_extract_pool_size, page_count)
+    bounds = [page_count * r // ranges for r in range(ranges + 1)]
+    parts = pool.map(_extract_page_range, [file_path] * ranges, bounds[:-1], bounds[1:])
+    return [text for part in parts for text in part]
+
+
+def _file_sha256(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _load_cached_chunks(cache_path, filename):
+    try:
+        with open(cache_path, "rb") as f:
+            entries = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable chunk cache '{cache_path}': {e}")
+        return None
+    try:
+        # mark as recently used for eviction
+        os.utime(cache_path)
+    except OSError:
+        pass
+    # source is the (per-request) file name, so it is filled in on load
+    return [
+        Document(page_content=content, metadata={"source": filename, "page": page})
+        for content, page in entries
+    ]
+
+
+def _save_cached_chunks(cache_path, chunks):
+    try:
+        os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
+        entries = [(chunk.page_content, chunk.metadata.get("page")) for chunk in chunks]
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        _evict_cached_chunks()
+    except Exception as e:
+        print(f"⚠️ Could not write chunk cache: {e}")
+
+
+def _evict_cached_chunks():
+    entries = []
+    for entry in os.scandir(CHUNK_CACHE_DIR):
+        if entry.name.endswith(".pkl"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                continue
+    if len(entries) <= CHUNK_CACHE_MAX_FILES:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - CHUNK_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_and_chunk(file_path, file_hash=None):
+    """
+    Load a .pdf / .docx file and split it into chunks (LangChain Documents).
+    file_hash: SHA-256 hex digest of the file, if the caller already has it;
+               used as the chunk cache key.
+    """
     ext = os.path.splitext(file_path)[1].lower()
     filename = os.path.basename(file_path)
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100
-    )
+    file_hash = file_hash or _file_sha256(file_path)
+    cache_path = os.path.join(CHUNK_CACHE_DIR, f"{file_hash}-v{CHUNK_CACHE_VERSION}{ext}.pkl")
+    chunks = _load_cached_chunks(cache_path, filename)
+    if chunks is not None:
+        print(f"📄 Loaded '{filename}' from chunk cache ({len(chunks)} chunks).")
+        return chunks
 
     chunks = []
 
     if ext == ".pdf":
-        # Lazy import to speed up startup
-        from langchain_community.document_loaders import PyPDFLoader
-        loader = PyPDFLoader(file_path)
-        docs = loader.load()
-        chunks = splitter.split_documents(docs)
-
-        for chunk in chunks:
-            page_number = chunk.metadata.get("page", "?")
-            try:
-                page_number = int(page_number)
-            except:
-                page_number = None
-
-            chunk.metadata = {
-                "source": filename,
-                "page": page_number
-            }
+        chunks = [
+            Document(
+                page_content=chunk,
+                metadata={"source": filename, "page": i}
+            )
+            for i, page_text in enumerate(extract_pdf_pages(file_path))
+            for chunk in fast_chunk(normalize_whitespace(page_text))
+        ]
 
     elif ext == ".docx":
         # Lazy import to speed up startup
         from docx import Document as DocxDocument
         docx = DocxDocument(file_path)
         raw_text = "\n".join([para.text for para in docx.paragraphs if para.text.strip()])
-        text_chunks = splitter.split_text(raw_text)
+        text_chunks = fast_chunk(normalize_whitespace(raw_text))
 
         chunks = [
             Document(
@@ -50,5 +198,6 @@ def load_and_chunk(file_path):
     else:
         raise ValueError("Unsupported file format. Only .pdf and .docx are supported.")
 
+    _save_cached_chunks(cache_path, chunks)
     print(f"📄 Loaded '{filename}' into {len(chunks)} chunks.")
     return chunks
@@ -0,0 +1,59 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Proximity cache defaults
+CACHE_CAPACITY = 512
+SIMILARITY_THRESHOLD = 0.97
+
+
+class ProximityCache:
+    """
+    Small in-process LRU cache keyed by question embedding.
+    A lookup hits when the cosine similarity to a cached key within the same
+    scope (e.g. document hash) is >= threshold.
+    """
+
+    def __init__(self, capacity=CACHE_CAPACITY, threshold=SIMILARITY_THRESHOLD):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._entries = OrderedDict()  # key -> (scope, unit embedding, docs, answer)
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def lookup(self, scope, embedding):
+        """Return cached (docs, answer) for the closest match, or None on a miss."""
+        query = self._normalize(embedding)
+        with self._lock:
+            keys = [k for k, entry in self._entries.items() if entry[0] == scope]
+            if not keys:
+                return None
+            matrix = np.stack([self._entries[k][1] for k in keys])
+            sims = matrix @ query
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            key = keys[best]
+            self._entries.move_to_end(key)
+            _, _, docs, answer = self._entries[key]
+            return docs, answer
+
+    def put(self, scope, embedding, docs, answer):
+        """Store an answer, evicting the least recently used entry when full."""
+        vec = self._normalize(embedding)
+        with self._lock:
+            self._entries[next(self._keys)] = (scope, vec, docs, answer)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+
+# shared cache (singleton)
+proximity_cache = ProximityCache()
@@ -1,24 +1,39 @@
 # semantic_searcher.py
-from utils.embedder import load_qdrant
+from utils.embedder import embed_query_cached, get_embeddings, search_qdrant_batch
+
+def _point_to_result(point):
+    metadata = point.payload.get("metadata") or {}
+    return {
+        "text": point.payload.get("page_content", ""),
+        "page": metadata.get("page", "?"),
+        "source": metadata.get("source", "unknown")
+    }
 
-# Load the Qdrant collection
-db = load_qdrant()
 
 def search(query, top_k=3):
     """
     Perform semantic search on Qdrant vector store.
+    Only the source, page and text payload fields are fetched (no vectors).
     Args:
         query (str): User query
         top_k (int): Number of results to return
     Returns:
         list of dicts with text, page, and source
     """
-    docs = db.similarity_search(query, k=top_k)
-    results = []
-    for doc in docs:
-        results.append({
-            "text": doc.page_content,
-            "page": doc.metadata.get("page", "?"),
-            "source": doc.metadata.get("source", "unknown")
-        })
-    return results
+    points = search_qdrant_batch([embed_query_cached(query)], k=top_k)[0]
+    return [_point_to_result(point) for point in points]
+
+
+def search_many(queries, top_k=3):
+    """
+    Perform semantic search for several queries at once: one batched
+    embedding pass and one Qdrant search_batch round-trip.
+    Args:
+        queries (list[str]): User queries
+        top_k (int): Number of results to return per query
+    Returns:
+        list (one per query) of lists of dicts with text, page, and source
+    """
+    vectors = get_embeddings().embed_documents(queries)
+    batches = search_qdrant_batch(vectors, k=top_k)
+    return [[_point_to_result(point) for point in points] for points in batches]